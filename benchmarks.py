@@ -0,0 +1,211 @@
+'''Benchmark suite for the network builders, the invariants and the tests.
+
+Every benchmark runs on the graph families of generators.py at a few sizes.
+For each (graph, benchmark) case the best time of several runs and the
+peak memory traced by tracemalloc in as many extra runs are written as JSON, and
+can be compared against a stored baseline:
+
+    python benchmarks.py -o baseline.json
+    python benchmarks.py -o current.json --baseline baseline.json
+
+The comparison exits with status 1 if any case is slower or needs more
+memory than the baseline by more than the tolerance. Timings are only
+comparable between runs on the same machine.
+'''
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from time import perf_counter
+
+from graph import Graph
+import generators
+
+# family: (generator, list of argument tuples)
+FAMILIES = {
+    'grid': (generators.grid, [(3, 3), (4, 4)]),
+    'hypercube': (generators.hypercube, [(3,), (4,)]),
+    'petersen': (generators.petersen, [(5, 2), (7, 2)]),
+    'random_regular': (generators.random_regular, [(10, 3), (14, 3)]),
+    'path': (generators.path, [(10,), (20,)]),
+    'paley': (generators.paley, [(13,), (17,)]),
+}
+
+def bench_minimal_oneway_network(graph):
+    def run():
+        for v in graph:
+            Graph.minimal_oneway_network(graph, v)
+    return run
+
+def bench_twoway_network(graph):
+    vertices = list(graph)
+    def run():
+        Graph.twoway_network(graph, vertices[0], vertices[-1])
+    return run
+
+def bench_twoway_networks(graph):
+    def run():
+        Graph.twoway_networks(graph, degree_dict=True)
+    return run
+
+def bench_compute_bidirectional_degree_profiles(graph):
+    nets = [Graph.minimal_oneway_network(graph, v) for v in graph]
+    def run():
+        for net in nets:
+            Graph.compute_bidirectional_degree_profiles(net)
+    return run
+
+def bench_find_loops_and_dead_end_branches(graph):
+    cases = []
+    for v in graph:
+        net = Graph.minimal_oneway_network(graph, v)
+        cases.append((net, Graph.compute_bidirectional_degree_profiles(net)[2]))
+    def run():
+        for net, rdm in cases:
+            Graph.find_loops_and_dead_end_branches(net, rdm)
+    return run
+
+def bench_get_loops_and_dead_end_branches_intersections(graph):
+    results = []
+    for v in graph:
+        net = Graph.minimal_oneway_network(graph, v)
+        rdm = Graph.compute_bidirectional_degree_profiles(net)[2]
+        results.append(Graph.find_loops_and_dead_end_branches(net, rdm)[1])
+    def run():
+        for res in results:
+            Graph.get_loops_and_dead_end_branches_intersections(res)
+    return run
+
+def bench_test_is_isomorphic(graph):
+    partner = generators.relabel(graph)
+    def run():
+        # The reference vertex is chosen at random
+        random.seed(0)
+        Graph(graph, partner).test_is_isomorphic()
+    return run
+
+def bench_test_find_orbits(graph):
+    partner = generators.relabel(graph)
+    def run():
+        Graph(graph, partner).test_find_orbits()
+    return run
+
+BENCHMARKS = {
+    'minimal_oneway_network': bench_minimal_oneway_network,
+    'twoway_network': bench_twoway_network,
+    'twoway_networks': bench_twoway_networks,
+    'compute_bidirectional_degree_profiles': bench_compute_bidirectional_degree_profiles,
+    'find_loops_and_dead_end_branches': bench_find_loops_and_dead_end_branches,
+    'get_loops_and_dead_end_branches_intersections': bench_get_loops_and_dead_end_branches_intersections,
+    'test_is_isomorphic': bench_test_is_isomorphic,
+    'test_find_orbits': bench_test_find_orbits,
+}
+
+def iter_cases(pattern=None):
+    """Yield (case_name, graph, benchmark_name) for every case matching pattern."""
+    for family, (generator, sizes) in FAMILIES.items():
+        for args in sizes:
+            graph = generator(*args)
+            graph_name = '%s-%s' % (family, 'x'.join(map(str, args)))
+            for bench in BENCHMARKS:
+                name = '%s/%s' % (graph_name, bench)
+                if pattern is None or pattern in name:
+                    yield name, graph, bench
+
+def measure(run, repeat):
+    """Return (best seconds, lowest peak traced bytes) of repeat runs each.
+
+    A full collection before every traced run empties the interpreter's free
+    lists, so each run allocates from scratch and the peak does not depend on
+    the cases that ran before it.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        run()
+        best = min(best, perf_counter() - start)
+
+    peak = None
+    for _ in range(repeat):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            traced = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        peak = traced if peak is None else min(peak, traced)
+
+    return best, peak
+
+def run_suite(pattern=None, repeat=3):
+    """Run the suite and return the results in the JSON layout of the files."""
+    results = {}
+    for name, graph, bench in iter_cases(pattern):
+        seconds, peak = measure(BENCHMARKS[bench](graph), repeat)
+        results[name] = {'vertices': len(graph), 'seconds': seconds, 'peak_bytes': peak}
+        print('%-70s %10.6fs %12d B' % (name, seconds, peak), file=sys.stderr)
+
+    meta = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+    }
+    return {'meta': meta, 'results': results}
+
+def compare(current, baseline, tolerance=0.25, min_seconds=0.005, min_bytes=65536):
+    """Return a list of regression messages of current against baseline.
+
+    A case regresses if it is slower by more than tolerance (and by at least
+    min_seconds, to ignore timer noise) or needs more than tolerance more
+    memory (and at least min_bytes more, since the interpreter's own caches
+    and the garbage collector move small peaks between runs). Cases missing
+    from either file are ignored.
+    """
+    regressions = []
+    for name, new in sorted(current['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        if (new['seconds'] > old['seconds'] * (1 + tolerance)
+                and new['seconds'] - old['seconds'] >= min_seconds):
+            regressions.append('%s: %.6fs -> %.6fs' % (name, old['seconds'], new['seconds']))
+        if (new['peak_bytes'] > old['peak_bytes'] * (1 + tolerance)
+                and new['peak_bytes'] - old['peak_bytes'] >= min_bytes):
+            regressions.append('%s: %d B -> %d B' % (name, old['peak_bytes'], new['peak_bytes']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown and memory growth (default 0.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.005,
+                        help='ignore slowdowns smaller than this (default 0.005)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case (default 3)')
+    parser.add_argument('-k', '--filter', help='only run cases whose name contains this')
+    args = parser.parse_args(argv)
+
+    current = run_suite(args.filter, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(current, handle, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = compare(current, baseline, args.tolerance, args.min_seconds)
+        for line in regressions:
+            print('REGRESSION', line)
+        print('%d regressions against %s' % (len(regressions), args.baseline))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+'''Resumable, sharded computation of the README tables for graph collections.
+
+Pairs are formed as in the README: two graphs of a graph6/sparse6 file are
+compared only if they have the same number of vertices, number of edges and
+degree sequence. The work is done in two phases, both of which survive a
+crash or restart:
+
+1. Spill: the file is streamed once, and every graph line is appended to
+   one of N shard files chosen by a hash of its degree sequence, so each
+   group of candidate pairs lies in a single shard. A manifest written at
+   the end marks the phase as done.
+2. Count: shards are processed in a pool of worker processes. A worker
+   reads one shard, computes the vertex invariants of every graph of a
+   group once, classifies every pair of the group and appends a checkpoint
+   with the running counts to the shard's jsonl log every few thousand
+   pairs. On restart a shard continues after its last checkpoint, and
+   finished shards are skipped.
+
+Only one shard is in memory per worker, and per-pair results are never
+kept; false positives are also written to the log.
+
+The columns are those of the README tables. As there, every vertex of one
+graph is checked against every vertex of the other, and a pair of graphs
+is counted in one column by the invariants of its best matching vertex
+pair:
+
+    inv1      no vertex pair has equal BDP (invariant 1)
+    inv2      some vertex pair has equal BDP, none also equal invariant 2
+    inv3      some vertex pair has equal BDP and invariant 2, none also
+              equal invariant 3
+    fp        false positive: some vertex pair passes all three invariants,
+              although the graphs of the collection are not isomorphic
+
+    python census.py ge10c.g6 work-ge10c --shards 64 --workers 8
+'''
+import argparse
+import json
+import os
+import sys
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from graph import CSRGraph, Graph, SignatureInterner
+from graph6 import decode_line, trivial_invariants
+
+COLUMNS = ('pairs', 'inv1', 'inv2', 'inv3', 'fp')
+MANIFEST = 'manifest.json'
+
+def shard_path(workdir, shard):
+    return os.path.join(workdir, 'shard-%04d.g6' % shard)
+
+def log_path(workdir, shard):
+    return os.path.join(workdir, 'shard-%04d.log' % shard)
+
+def spill(path, workdir, shards):
+    """Phase 1: split the collection into shard files by degree-sequence hash.
+
+    Every shard line is '<index in the file> <graph6 or sparse6 string>'.
+    Returns the manifest; an existing manifest is reused if it was written
+    for the same file and number of shards.
+    """
+    manifest_path = os.path.join(workdir, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as handle:
+            manifest = json.load(handle)
+        if manifest['source'] != os.path.abspath(path) or manifest['shards'] != shards:
+            raise ValueError('%s was spilled from %s into %d shards'
+                             % (workdir, manifest['source'], manifest['shards']))
+        return manifest
+
+    os.makedirs(workdir, exist_ok=True)
+    handles = {}
+    graphs = 0
+    try:
+        with open(path, 'rb') as source:
+            for line in source:
+                graph = decode_line(line)
+                if graph is None:
+                    continue
+                key = repr(trivial_invariants(graph)).encode()
+                shard = zlib.crc32(key) % shards
+                if shard not in handles:
+                    handles[shard] = open(shard_path(workdir, shard), 'wb')
+                handles[shard].write(b'%d %s\n' % (graphs, line.strip()))
+                graphs += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    manifest = {'source': os.path.abspath(path), 'shards': shards,
+                'graphs': graphs, 'used': sorted(handles)}
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as handle:
+        json.dump(manifest, handle)
+    os.replace(tmp, manifest_path)
+    return manifest
+
+def vertex_signatures(graph, interner, csr=False, vectorized=False, bitset=False):
+    """Set of the interned (BDP, invariant 2, invariant 3) triples of all vertices."""
+    if csr or vectorized or bitset:
+        graph = CSRGraph(graph)
+    return {interner.intern_invariants(Graph.compute_vertex_invariants(graph, v, vectorized, bitset))
+            for v in graph}
+
+def classify_signatures(signatures1, signatures2):
+    """Return the column of COLUMNS for two sets of vertex_signatures."""
+    if signatures1 & signatures2:
+        return 'fp'
+    if {s[:2] for s in signatures1} & {s[:2] for s in signatures2}:
+        return 'inv3'
+    if {s[0] for s in signatures1} & {s[0] for s in signatures2}:
+        return 'inv2'
+    return 'inv1'
+
+def classify(graph1, graph2, **options):
+    """Return the column of COLUMNS a pair of graphs is counted in."""
+    interner = SignatureInterner()
+    return classify_signatures(vertex_signatures(graph1, interner, **options),
+                               vertex_signatures(graph2, interner, **options))
+
+def read_log(path):
+    """Return (last checkpoint or None, set of false positive index pairs) of a shard log.
+
+    A line cut short by a crash is ignored.
+    """
+    checkpoint = None
+    false_positives = set()
+    if not os.path.exists(path):
+        return checkpoint, false_positives
+    with open(path) as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'fp' in record:
+                false_positives.add(tuple(record['fp']))
+            else:
+                checkpoint = record
+    return checkpoint, false_positives
+
+def repair_log(path):
+    """Cut a line left incomplete by a crash off the end of a log, so that
+    the next record starts on a line of its own."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as handle:
+        data = handle.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            handle.truncate(end)
+
+def write_record(log, record):
+    log.write(json.dumps(record) + '\n')
+    log.flush()
+    os.fsync(log.fileno())
+
+def count_shard(workdir, shard, every=10000, options=None):
+    """Phase 2 for one shard: count its pairs, resuming after the last checkpoint.
+
+    Returns the final counts as a dict keyed by COLUMNS.
+    """
+    options = options or {}
+    repair_log(log_path(workdir, shard))
+    checkpoint, _ = read_log(log_path(workdir, shard))
+    if checkpoint is not None and checkpoint['finished']:
+        return checkpoint['counts']
+    done = checkpoint['done'] if checkpoint else 0
+    counts = dict(checkpoint['counts']) if checkpoint else dict.fromkeys(COLUMNS, 0)
+
+    groups = defaultdict(list)
+    with open(shard_path(workdir, shard), 'rb') as handle:
+        for line in handle:
+            index, data = line.split(b' ', 1)
+            groups[trivial_invariants(decode_line(data))].append((int(index), data))
+
+    position = 0
+    with open(log_path(workdir, shard), 'a') as log:
+        # Groups and pairs are always visited in the same order, so a
+        # checkpoint only needs the number of pairs done
+        for key in sorted(groups):
+            members = groups[key]
+            pairs = len(members) * (len(members) - 1) // 2
+            if position + pairs <= done:
+                position += pairs
+                continue
+            # Every graph of the group is compared with all others, so its
+            # invariants are computed once
+            interner = SignatureInterner()
+            signatures = [vertex_signatures(decode_line(line), interner, **options)
+                          for _, line in members]
+            for a, (i, _) in enumerate(members):
+                for b, (j, _) in enumerate(members[a + 1:], a + 1):
+                    if position < done:
+                        position += 1
+                        continue
+                    column = classify_signatures(signatures[a], signatures[b])
+                    counts[column] += 1
+                    counts['pairs'] += 1
+                    position += 1
+                    if column == 'fp':
+                        write_record(log, {'fp': [i, j]})
+                    if position % every == 0:
+                        write_record(log, {'done': position, 'counts': counts, 'finished': False})
+        write_record(log, {'done': position, 'counts': counts, 'finished': True})
+
+    return counts
+
+def run(path, workdir, shards=64, workers=None, every=10000, **options):
+    """Spill (if needed) and count all shards. Returns (totals, false positives)."""
+    manifest = spill(path, workdir, shards)
+    totals = dict.fromkeys(COLUMNS, 0)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(count_shard, workdir, shard, every, options)
+                   for shard in manifest['used']]
+        for future in as_completed(futures):
+            for column, value in future.result().items():
+                totals[column] += value
+
+    false_positives = set()
+    for shard in manifest['used']:
+        false_positives |= read_log(log_path(workdir, shard))[1]
+    return totals, sorted(false_positives)
+
+def format_row(name, totals):
+    """Row in the layout of the README tables."""
+    number = lambda n: '{:,}'.format(n).replace(',', ' ')
+    pairs = totals['pairs']
+    share = '%.4f%%' % (100.0 * totals['fp'] / pairs) if pairs else '—'
+    return '| %s | %s | %s | %s | %s | %s | %s |' % (
+        name, number(pairs), number(totals['inv1']),
+        number(totals['inv2']), number(totals['inv3']), number(totals['fp']), share)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('file', help='graph6 or sparse6 collection')
+    parser.add_argument('workdir', help='directory for shards, logs and the manifest')
+    parser.add_argument('--shards', type=int, default=64, help='number of shards (default 64)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: all CPUs)')
+    parser.add_argument('--every', type=int, default=10000,
+                        help='pairs between checkpoints (default 10000)')
+    parser.add_argument('--csr', action='store_true', help='run the tests on CSR graphs')
+    args = parser.parse_args(argv)
+
+    totals, false_positives = run(args.file, args.workdir, args.shards, args.workers,
+                                  args.every, csr=args.csr)
+    for i, j in false_positives:
+        print('false positive: graphs %d and %d' % (i, j))
+    print(format_row(os.path.basename(args.file), totals))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
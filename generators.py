@@ -0,0 +1,146 @@
+'''Parameterised graph families for benchmarks and scaling runs.
+
+Every generator returns adjacency lists in the dict-of-lists form used by
+Graph. Random families take a seed, so a benchmark always sees the same
+graphs.
+
+>>> sorted(grid(2, 2).items())
+[((0, 0), [(1, 0), (0, 1)]), ((0, 1), [(1, 1), (0, 0)]), ((1, 0), [(0, 0), (1, 1)]), ((1, 1), [(0, 1), (1, 0)])]
+>>> len(hypercube(4)), len(petersen(5, 2)[0])
+(16, 3)
+>>> len(cfi(hypercube(3))), len(torus(3, 4))
+(80, 12)
+>>> len(paley(13)[0])
+6
+'''
+from itertools import combinations
+from random import Random
+
+def grid(rows, cols):
+    """rows x cols grid graph with (row, column) tuple labels, as in example6."""
+    g = {}
+    for i in range(rows):
+        for j in range(cols):
+            g[(i, j)] = [(x, y) for x, y in ((i + 1, j), (i - 1, j), (i, j + 1), (i, j - 1))
+                         if 0 <= x < rows and 0 <= y < cols]
+    return g
+
+def hypercube(dim):
+    """dim-dimensional hypercube; vertices are the integers 0..2**dim-1 (cube is dim=3)."""
+    return {v: [v ^ 1 << b for b in range(dim)] for v in range(1 << dim)}
+
+def petersen(n, k):
+    """Generalised Petersen graph GP(n, k); example3 is GP(5, 2).
+
+    Vertices 0..n-1 form the outer cycle and n..2n-1 the inner star polygon.
+    """
+    g = {v: [] for v in range(2 * n)}
+    for i in range(n):
+        for u, v in ((i, (i + 1) % n), (i, n + i), (n + i, n + (i + k) % n)):
+            g[u].append(v)
+            g[v].append(u)
+    return g
+
+def torus(rows, cols):
+    """rows x cols torus (grid with wrap-around), 4-regular for rows, cols >= 3."""
+    return {(i, j): [((i + 1) % rows, j), ((i - 1) % rows, j), (i, (j + 1) % cols), (i, (j - 1) % cols)]
+            for i in range(rows) for j in range(cols)}
+
+def paley(q):
+    """Paley graph on the integers mod a prime q = 1 (mod 4): u and v are
+    adjacent when u - v is a non-zero square. Dense and strongly regular."""
+    if q % 4 != 1 or any(q % p == 0 for p in range(2, int(q ** 0.5) + 1)):
+        raise ValueError('Paley graphs need a prime q = 1 (mod 4), got %d' % q)
+    squares = {x * x % q for x in range(1, q)}
+    return {v: [(v + s) % q for s in sorted(squares)] for v in range(q)}
+
+def random_regular(n, d, seed=0):
+    """Random simple d-regular graph on n vertices (pairing model with restarts)."""
+    if n * d % 2 or d >= n:
+        raise ValueError('no simple %d-regular graph on %d vertices' % (d, n))
+
+    rng = Random(seed)
+    while True:
+        points = [v for v in range(n) for _ in range(d)]
+        rng.shuffle(points)
+        g = {v: [] for v in range(n)}
+        for u, v in zip(points[::2], points[1::2]):
+            if u == v or v in g[u]:
+                break
+            g[u].append(v)
+            g[v].append(u)
+        else:
+            return g
+
+def erdos_renyi(n, p, seed=0, connected=True):
+    """G(n, p) random graph. With connected=True, graphs are drawn (with the
+    following seeds) until a connected one is found."""
+    rng = Random(seed)
+    while True:
+        g = {v: [] for v in range(n)}
+        for u, v in combinations(range(n), 2):
+            if rng.random() < p:
+                g[u].append(v)
+                g[v].append(u)
+        if not connected or is_connected(g):
+            return g
+
+def cfi(base, twisted=False):
+    """Cai-Fürer-Immerman graph over a connected base graph of minimum degree 3.
+
+    Every vertex v of degree d becomes 2**(d-1) middle vertices ('m', v, S),
+    one for each even subset S of its edges, and two vertices ('a', v, u, 0)
+    and ('a', v, u, 1) for every edge vu. ('m', v, S) is joined to
+    ('a', v, u, 1) if vu is in S and to ('a', v, u, 0) otherwise, and the
+    pairs of both ends of an edge are joined bit to bit. With twisted=True one
+    edge joins bit i to bit 1 - i. The twisted and untwisted graphs over the
+    same base are not isomorphic but are hard to tell apart by refinement.
+    """
+    g = {}
+    for v, nbs in base.items():
+        for u in nbs:
+            g[('a', v, u, 0)] = []
+            g[('a', v, u, 1)] = []
+        for k in range(0, len(nbs) + 1, 2):
+            for subset in combinations(nbs, k):
+                m = ('m', v, subset)
+                g[m] = [('a', v, u, 1 if u in subset else 0) for u in nbs]
+                for a in g[m]:
+                    g[a].append(m)
+
+    twist = twisted
+    for v, nbs in base.items():
+        for u in nbs:
+            if repr(v) < repr(u):
+                for i in (0, 1):
+                    j = 1 - i if twist else i
+                    g[('a', v, u, i)].append(('a', u, v, j))
+                    g[('a', u, v, j)].append(('a', v, u, i))
+                twist = False
+    return g
+
+def is_connected(graph):
+    """True if every vertex of an undirected graph is reachable from the first one."""
+    if not graph:
+        return True
+    start = next(iter(graph))
+    seen = {start}
+    stack = [start]
+    while stack:
+        for u in graph[stack.pop()]:
+            if u not in seen:
+                seen.add(u)
+                stack.append(u)
+    return len(seen) == len(graph)
+
+def path(n):
+    """Path on n vertices 0..n-1."""
+    return {v: [u for u in (v - 1, v + 1) if 0 <= u < n] for v in range(n)}
+
+def relabel(graph, seed=0):
+    """Copy of graph with shuffled integer labels, an isomorphic partner for the tests."""
+    vertices = list(graph)
+    shuffled = list(range(len(vertices)))
+    Random(seed).shuffle(shuffled)
+    mapping = dict(zip(vertices, shuffled))
+    return {mapping[v]: [mapping[u] for u in graph[v]] for v in vertices}
@@ -0,0 +1,195 @@
+'''Streaming graph6/sparse6 reader and batch runner for graph collections.
+
+The formats are described in McKay's formats.txt
+(https://users.cecs.anu.edu.au/~bdm/data/formats.txt). Graphs are decoded one
+line at a time into the dict-of-lists form used by Graph, with vertices
+labelled 0..n-1, so a file is never loaded into memory as a whole.
+
+>>> g = decode_graph6(b'Bw')
+>>> g
+{0: [1, 2], 1: [0, 2], 2: [0, 1]}
+>>> Graph(g, decode_sparse6(b':Bc')).test_is_isomorphic()
+False
+'''
+import sys
+
+from graph import Graph
+
+GRAPH6_HEADER = b'>>graph6<<'
+SPARSE6_HEADER = b'>>sparse6<<'
+
+def _decode_size(data):
+    """Decode N(n) from the start of data. Returns (n, number_of_bytes_used)."""
+    if data[0] != 126:
+        return data[0] - 63, 1
+    if data[1] != 126:
+        return (data[1] - 63) << 12 | (data[2] - 63) << 6 | (data[3] - 63), 4
+    n = 0
+    for c in data[2:8]:
+        n = n << 6 | (c - 63)
+    return n, 8
+
+def decode_graph6(line):
+    """Decode one graph6 line (bytes, without the optional header) to adjacency lists."""
+    data = line.strip()
+    if data.startswith(GRAPH6_HEADER):
+        data = data[len(GRAPH6_HEADER):]
+
+    n, k = _decode_size(data)
+    graph = {v: [] for v in range(n)}
+    bits = data[k:]
+
+    pos = 0
+    for j in range(1, n):
+        for i in range(j):
+            if (bits[pos // 6] - 63) >> (5 - pos % 6) & 1:
+                graph[i].append(j)
+                graph[j].append(i)
+            pos += 1
+
+    return graph
+
+def decode_sparse6(line):
+    """Decode one sparse6 line (bytes, starting with ':') to adjacency lists.
+
+    Multiple edges are kept as repeated neighbours and a loop adds the
+    vertex once to its own list, as in the multigraph examples.
+    """
+    data = line.strip()
+    if data.startswith(SPARSE6_HEADER):
+        data = data[len(SPARSE6_HEADER):]
+    if data[:1] != b':':
+        raise ValueError('not a sparse6 string: %r' % line)
+
+    n, k = _decode_size(data[1:])
+    graph = {v: [] for v in range(n)}
+    chunks = [c - 63 for c in data[1 + k:]]
+
+    width = 1
+    while 1 << width < n:
+        width += 1
+
+    v = 0
+    pos = 0
+    total = 6 * len(chunks)
+    while pos + 1 + width <= total:
+        b = chunks[pos // 6] >> (5 - pos % 6) & 1
+        pos += 1
+        x = 0
+        for _ in range(width):
+            x = x << 1 | (chunks[pos // 6] >> (5 - pos % 6) & 1)
+            pos += 1
+
+        if b:
+            v += 1
+        # Padding with ones may produce an overlarge value at the end
+        if x >= n or v >= n:
+            break
+        if x > v:
+            v = x
+        else:
+            graph[x].append(v)
+            if x != v:
+                graph[v].append(x)
+
+    return graph
+
+def decode_line(line):
+    """Decode a graph6 or sparse6 line. Returns None for blank lines."""
+    data = line.strip()
+    for header in (GRAPH6_HEADER, SPARSE6_HEADER):
+        if data.startswith(header):
+            data = data[len(header):]
+    if not data:
+        return None
+    if data[:1] == b':':
+        return decode_sparse6(data)
+    if data[:1] in (b';', b'&'):
+        raise ValueError('incremental sparse6 and digraph6 are not supported')
+    return decode_graph6(data)
+
+def iter_lines(handle):
+    """Yield (line, graph) for every graph read from a binary file handle."""
+    while True:
+        line = handle.readline()
+        if not line:
+            return
+        graph = decode_line(line)
+        if graph is not None:
+            yield line, graph
+
+def read_graphs(path):
+    """Lazily yield the graphs of a graph6/sparse6 file one at a time."""
+    with open(path, 'rb') as handle:
+        for _, graph in iter_lines(handle):
+            yield graph
+
+def trivial_invariants(graph):
+    """Vertex count, edge count and degree sequence used to group candidate pairs."""
+    degrees = sorted(len(values) for values in graph.values())
+    return len(graph), sum(degrees), tuple(degrees)
+
+def iter_pairs(path):
+    """Yield (i, g1, j, g2) for every pair i < j with equal trivial invariants.
+
+    A first pass groups the file offsets of the graphs by their trivial
+    invariants, as census.spill groups them into shards. Each group of two
+    or more graphs is then decoded once and paired within itself, so every
+    graph is decoded at most twice. Groups come in the order of their first
+    graph and pairs in (i, j) order within a group. Memory holds one offset
+    per graph and the graphs of one group.
+    """
+    groups = {}
+    with open(path, 'rb') as handle:
+        i = 0
+        while True:
+            offset = handle.tell()
+            line = handle.readline()
+            if not line:
+                break
+            graph = decode_line(line)
+            if graph is not None:
+                groups.setdefault(trivial_invariants(graph), []).append((i, offset))
+                i += 1
+
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            graphs = []
+            for i, offset in members:
+                handle.seek(offset)
+                graphs.append((i, decode_line(handle.readline())))
+            for k, (i, g1) in enumerate(graphs):
+                for j, g2 in graphs[k + 1:]:
+                    yield i, g1, j, g2
+
+def batch_test(path, orbits=False, **options):
+    """Run every candidate pair of a graph6/sparse6 file through the tests.
+
+    Pairs are formed as in the README: only graphs with the same number of
+    vertices, number of edges and degree sequence are compared.
+
+    Args:
+        path (str): graph6 or sparse6 file.
+        orbits (bool): If True, run test_find_orbits instead of test_is_isomorphic.
+        **options: Passed to Graph (e.g. csr=True).
+
+    Yields:
+        tuple: (i, j, result) with the file indices of both graphs.
+    """
+    for i, g1, j, g2 in iter_pairs(path):
+        graph = Graph(g1, g2, **options)
+        yield i, j, graph.test_find_orbits() if orbits else graph.test_is_isomorphic()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: python graph6.py FILE [--orbits]')
+
+    orbits = '--orbits' in sys.argv[2:]
+    pairs = positives = 0
+    for i, j, result in batch_test(sys.argv[1], orbits=orbits):
+        pairs += 1
+        if result:
+            positives += 1
+            print(i, j)
+    print('pairs: %d, reported isomorphic: %d' % (pairs, positives))
@@ -0,0 +1,225 @@
+'''Scaling harness for test_is_isomorphic and test_find_orbits.
+
+Runs both tests on families of growing graphs from generators.py (CFI
+graphs over random cubic graphs, random regular graphs, Erdos-Renyi graphs,
+tori and the strongly regular Paley graphs). Every case runs in its own process under a time and memory
+budget. Once a case of a family exceeds a budget, the larger sizes of that
+family are skipped, so the first failure marks the scaling limit.
+
+For each family and test the log-log slope of runtime against the work
+bound of the README is fitted: |V|*(|V|+|E|) for test_is_isomorphic and
+|V|^2*(|V|+|E|) for test_find_orbits. A slope above 1 + slack means the
+runtime grows faster than claimed. Results are written as CSV, and as a
+log-log chart if matplotlib is installed:
+
+    python scaling.py -o scaling.csv --plot scaling.png --seconds 60 --memory 2048
+'''
+import argparse
+import csv
+import math
+import multiprocessing
+import sys
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from graph import Graph
+import generators
+
+def cfi_pair(n, twisted):
+    # The second graph is relabelled, so the untwisted pair is not simply
+    # the same dict twice
+    base = generators.random_regular(n, 3, seed=n)
+    return generators.cfi(base), generators.relabel(generators.cfi(base, twisted=twisted), seed=n)
+
+# family: (list of sizes, function of a size returning the pair to test,
+#          expected result of test_is_isomorphic)
+FAMILIES = {
+    'cfi': ([4, 6, 8, 10, 12], lambda n: cfi_pair(n, True), False),
+    'cfi-iso': ([4, 6, 8, 10, 12], lambda n: cfi_pair(n, False), True),
+    'random_regular': ([8, 16, 24, 32, 48, 64],
+                       lambda n: (generators.random_regular(n, 3, seed=n),
+                                  generators.relabel(generators.random_regular(n, 3, seed=n))),
+                       True),
+    'erdos_renyi': ([8, 16, 24, 32, 48, 64],
+                    lambda n: (generators.erdos_renyi(n, 2 * math.log(n) / n, seed=n),
+                               generators.relabel(generators.erdos_renyi(n, 2 * math.log(n) / n, seed=n))),
+                    True),
+    'torus': ([3, 4, 5, 6, 7, 8],
+              lambda n: (generators.torus(n, n), generators.relabel(generators.torus(n, n))),
+              True),
+    # Strongly regular: the number of common neighbours of two vertices
+    # only depends on whether they are adjacent, so degrees tell nothing
+    'paley': ([13, 17, 29, 37, 41, 53],
+              lambda q: (generators.paley(q), generators.relabel(generators.paley(q))),
+              True),
+}
+
+# Work bounds claimed in the README
+BOUNDS = {
+    'test_is_isomorphic': lambda v, e: v * (v + e),
+    'test_find_orbits': lambda v, e: v * v * (v + e),
+}
+
+def run_case(family, size, test, memory, queue):
+    """Child process: build the pair, run the test and report (seconds, peak KiB, result)."""
+    if resource is not None and memory:
+        limit = memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    graph1, graph2 = FAMILIES[family][1](size)
+    start = perf_counter()
+    try:
+        result = getattr(Graph(graph1, graph2), test)()
+    except MemoryError:
+        queue.put(('memory', perf_counter() - start, None, None))
+        return
+    seconds = perf_counter() - start
+
+    # Peak resident size of the whole child, interpreter included; ru_maxrss
+    # is in KiB on Linux (bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+    queue.put(('ok', seconds, peak, result if test == 'test_is_isomorphic' else result is not None))
+
+def measure(family, size, test, seconds, memory):
+    """Run one case in a child process. Returns (status, seconds, peak, result)."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_case, args=(family, size, test, memory, queue))
+    process.start()
+    process.join(seconds)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        return 'timeout', seconds, None, None
+    if queue.empty():
+        # Killed by the system, e.g. out of memory outside the interpreter
+        return 'crashed', None, None, None
+    return queue.get()
+
+def slope(points):
+    """Least-squares slope of log(y) against log(x)."""
+    xs = [math.log(x) for x, _ in points]
+    ys = [math.log(y) for _, y in points]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    sxx = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx if sxx else float('nan')
+
+def run(families, tests, seconds, memory):
+    """Run all cases; returns a list of row dicts."""
+    rows = []
+    for family in families:
+        sizes, make, expected = FAMILIES[family]
+        for test in tests:
+            for size in sizes:
+                graph1, _ = make(size)
+                v = len(graph1)
+                e = sum(len(nbs) for nbs in graph1.values()) // 2
+                status, elapsed, peak, result = measure(family, size, test, seconds, memory)
+                row = {'family': family, 'test': test, 'size': size, 'vertices': v, 'edges': e,
+                       'work': BOUNDS[test](v, e), 'status': status, 'seconds': elapsed,
+                       'peak_kib': peak, 'result': result,
+                       'expected': expected if test == 'test_is_isomorphic' else None}
+                rows.append(row)
+                print('%-15s %-19s |V|=%-5d |E|=%-5d %-8s %s' % (
+                    family, test, v, e, status, '' if elapsed is None else '%.3fs' % elapsed),
+                    file=sys.stderr)
+                if status != 'ok':
+                    break
+    return rows
+
+def check(rows, slack=0.25):
+    """Fit the slopes of every (family, test) and compare them with the bounds.
+
+    Returns a list of (family, test, slope against work, slope against |V|,
+    verdict) tuples. At least three finished sizes are needed for a fit.
+    """
+    report = []
+    groups = {}
+    for row in rows:
+        if row['status'] == 'ok' and row['seconds'] > 0:
+            groups.setdefault((row['family'], row['test']), []).append(row)
+    for (family, test), group in groups.items():
+        if len(group) < 3:
+            report.append((family, test, None, None, 'too few points'))
+            continue
+        by_work = slope([(r['work'], r['seconds']) for r in group])
+        by_vertices = slope([(r['vertices'], r['seconds']) for r in group])
+        report.append((family, test, by_work, by_vertices,
+                       'ok' if by_work <= 1 + slack else 'exceeds bound'))
+    return report
+
+def write_csv(rows, path):
+    with open(path, 'w', newline='') as handle:
+        writer = csv.DictWriter(handle, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def plot(rows, path):
+    """Log-log chart of runtime and peak memory against |V|. Needs matplotlib."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, (ax_time, ax_memory) = plt.subplots(1, 2, figsize=(12, 5))
+    groups = {}
+    for row in rows:
+        if row['status'] == 'ok':
+            groups.setdefault((row['family'], row['test']), []).append(row)
+    for (family, test), group in sorted(groups.items()):
+        label = '%s %s' % (family, test.replace('test_', ''))
+        vs = [r['vertices'] for r in group]
+        ax_time.plot(vs, [r['seconds'] for r in group], 'o-', label=label)
+        if all(r['peak_kib'] for r in group):
+            ax_memory.plot(vs, [r['peak_kib'] / 1024 for r in group], 'o-', label=label)
+    for ax, ylabel in ((ax_time, 'seconds'), (ax_memory, 'peak MiB')):
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel('|V|')
+        ax.set_ylabel(ylabel)
+    ax_time.legend(fontsize='small')
+    fig.tight_layout()
+    fig.savefig(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', default='scaling.csv', help='CSV file (default scaling.csv)')
+    parser.add_argument('--plot', help='also draw a log-log chart to this file (needs matplotlib)')
+    parser.add_argument('--seconds', type=float, default=60, help='time budget per case (default 60)')
+    parser.add_argument('--memory', type=int, default=2048, help='memory budget per case in MiB (default 2048)')
+    parser.add_argument('--slack', type=float, default=0.25,
+                        help='allowed excess of the fitted slope over 1 (default 0.25)')
+    parser.add_argument('--family', action='append', choices=sorted(FAMILIES),
+                        help='only run this family (may be repeated)')
+    parser.add_argument('--test', action='append', choices=sorted(BOUNDS),
+                        help='only run this test (may be repeated)')
+    args = parser.parse_args(argv)
+
+    rows = run(args.family or list(FAMILIES), args.test or list(BOUNDS), args.seconds, args.memory)
+    write_csv(rows, args.output)
+
+    if args.plot:
+        try:
+            plot(rows, args.plot)
+        except ImportError:
+            print('matplotlib is not installed; only %s was written' % args.output, file=sys.stderr)
+
+    wrong = [r for r in rows if r['expected'] is not None and r['result'] is not None
+             and r['result'] != r['expected']]
+    for r in wrong:
+        print('WRONG %s |V|=%d: %s returned %s' % (r['family'], r['vertices'], r['test'], r['result']))
+
+    exceeded = 0
+    for family, test, by_work, by_vertices, verdict in check(rows, args.slack):
+        if by_work is None:
+            print('%-15s %-19s %s' % (family, test, verdict))
+        else:
+            print('%-15s %-19s slope %.2f against the bound, %.2f against |V|: %s'
+                  % (family, test, by_work, by_vertices, verdict))
+        exceeded += verdict == 'exceeds bound'
+    return 1 if exceeded else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
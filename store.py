@@ -0,0 +1,290 @@
+'''Persistent store of precomputed vertex invariants.
+
+A store is a directory that holds, for every stored graph, the interned IDs
+of the BDP and invariants 2 and 3 of all its vertices. Graphs are keyed by a
+fingerprint of their adjacency lists and labels. All graphs share one
+signature table, so their IDs are comparable with each other and with the
+IDs of any graph compared through the store.
+
+Files:
+    signatures.bin      marshal records of the signature table in ID order,
+                        only ever appended to
+    lock                taken by add() while it extends the table
+    <fingerprint>.meta  marshal of the vertex labels, the layer-profile
+                        trie (see Graph.add_profile_path) of the graph and
+                        the size of the table its IDs refer to
+    <fingerprint>.ids   3 native int64 per vertex (BDP, invariant 2,
+                        invariant 3), read through mmap without copying
+
+A graph is added once and then passed to Graph(..., store=store), which
+loads its IDs instead of building networks for its vertices:
+
+    with InvariantStore('invariants') as store:
+        for g in read_graphs('ge10c.g6'):
+            store.add(g)
+        Graph(new_graph, g, store=store).test_find_orbits()
+
+load() maps the .ids file of every graph it reads once and keeps the map;
+close() (or leaving the with block) unmaps them.
+
+An ID is the position of a signature in signatures.bin, so the table may
+only grow by one writer at a time. add() holds an exclusive lock on the
+lock file and first reads the records other writers appended, so any
+number of InvariantStore instances and processes may add graphs to one
+directory. The lock needs fcntl; elsewhere only one writer may use a store
+at a time.
+
+Signatures of graphs compared through the store but not added to it go to
+an OverlayInterner of the test and never reach the table.
+
+Only the standard library is needed. StoredGraph.array returns a NumPy
+view if NumPy is installed.
+'''
+import hashlib
+import marshal
+import mmap
+import os
+from array import array
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from graph import CSRGraph, Graph, SignatureInterner
+
+SIGNATURES = 'signatures.bin'
+
+def fingerprint(graph):
+    """Hex digest of the adjacency lists of a graph, labels included."""
+    digest = hashlib.sha256()
+    for v in sorted(graph, key=repr):
+        digest.update(repr((v, sorted(graph[v], key=repr))).encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+class StoredGraph:
+    """Precomputed invariant IDs of one stored graph.
+
+    ids is a flat memoryview of int64 backed by the mmapped file, with the
+    IDs of the vertex labels[i] at positions 3i, 3i+1 and 3i+2.
+    """
+    __slots__ = ('fingerprint', 'labels', 'index', 'trie', 'size', 'ids')
+
+    def __init__(self, fingerprint, labels, trie, size, ids):
+        self.fingerprint = fingerprint
+        self.labels = labels
+        self.index = {label: i for i, label in enumerate(labels)}
+        self.trie = trie
+        self.size = size
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.labels)
+
+    def signature(self, label):
+        """(bdp_id, ld2_id, ld3_id) of a vertex."""
+        i = 3 * self.index[label]
+        return self.ids[i], self.ids[i + 1], self.ids[i + 2]
+
+    def array(self):
+        """The IDs as an (n, 3) array without copying: NumPy if available,
+        otherwise a two-dimensional memoryview."""
+        if np is not None:
+            return np.frombuffer(self.ids, dtype=np.int64).reshape(-1, 3)
+        return self.ids.cast('B').cast('q', (len(self.labels), 3))
+
+class OverlayInterner(SignatureInterner):
+    """Interner of one test on top of the table of a store.
+
+    Signatures already in the first len(base) entries of the base table
+    keep their stored IDs; new ones get the following IDs in this overlay
+    only, so the base table is never changed.
+    """
+    __slots__ = ('base', 'offset')
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+        self.offset = len(base)
+
+    def __len__(self):
+        return self.offset + len(self.values)
+
+    def intern(self, signature):
+        sid = self.base.ids.get(signature)
+        if sid is not None and sid < self.offset:
+            return sid
+        sid = self.ids.get(signature)
+        if sid is None:
+            sid = self.ids[signature] = self.offset + len(self.values)
+            self.values.append(signature)
+        return sid
+
+    def lookup(self, sid):
+        if sid < self.offset:
+            return self.base.values[sid]
+        return self.values[sid - self.offset]
+
+class InvariantStore:
+    """Directory of precomputed vertex invariants; see the module docstring.
+
+    Args:
+        path (str): Directory of the store, created if missing.
+    """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.interner = SignatureInterner()
+        self._offset = 0
+        self._maps = {}
+        self.sync()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def close(self):
+        """Unmap the .ids files opened by load. StoredGraphs returned by load
+        must not be used afterwards; the store itself can, and maps again."""
+        for ids in self._maps.values():
+            if isinstance(ids, mmap.mmap):
+                try:
+                    ids.close()
+                except BufferError:
+                    # Still viewed by a live StoredGraph, which keeps the map
+                    # until it is collected
+                    pass
+        self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def _lock(self):
+        with open(self._file('lock'), 'a') as handle:
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+    def sync(self, truncate=False):
+        """Read the signatures appended to the table file since the last sync.
+
+        A record cut short by a crash (or still being written by another
+        writer) ends the read; no .ids file refers to it. With truncate=True,
+        which add() only uses under the lock, it is cut off the file.
+        """
+        path = self._file(SIGNATURES)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as handle:
+            handle.seek(self._offset)
+            while True:
+                try:
+                    value = marshal.load(handle)
+                except (EOFError, ValueError):
+                    break
+                self.interner.intern(value)
+                self._offset = handle.tell()
+        if truncate and self._offset != os.path.getsize(path):
+            os.truncate(path, self._offset)
+
+    def _append(self, start):
+        """Append the signatures interned from ID start on to the table file."""
+        with open(self._file(SIGNATURES), 'ab') as handle:
+            for value in self.interner.values[start:]:
+                marshal.dump(value, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+            self._offset = handle.tell()
+
+    def _rollback(self, start):
+        """Forget the signatures interned from ID start on."""
+        for value in self.interner.values[start:]:
+            del self.interner.ids[value]
+        del self.interner.values[start:]
+
+    def overlay(self):
+        """A fresh OverlayInterner over the current table, for one test."""
+        self.sync()
+        return OverlayInterner(self.interner)
+
+    def __contains__(self, graph):
+        return os.path.exists(self._file(fingerprint(graph) + '.ids'))
+
+    def add(self, graph, vectorized=False, bitset=False):
+        """Compute and store the invariants of every vertex of graph.
+
+        Returns the fingerprint. A graph that is already stored is skipped.
+        The invariants are computed under the lock, so that they are
+        interned into a table that no other writer extends meanwhile.
+        """
+        key = fingerprint(graph)
+        ids_path = self._file(key + '.ids')
+        if os.path.exists(ids_path):
+            return key
+
+        with self._lock():
+            self.sync(truncate=True)
+            if os.path.exists(ids_path):
+                return key
+            start = len(self.interner)
+            try:
+                owner = Graph(graph, csr=True, vectorized=vectorized, bitset=bitset)
+                csr = CSRGraph(graph)
+                ids = array('q')
+                trie = {}
+                for v in csr.keys():
+                    net, fwd, rev, rdm, inv_net = owner.build_network_profiles(csr, v)
+                    Graph.add_profile_path(trie, net)
+                    ld2_inv, ld2_res = owner.compute_ld2(net, rdm, inv_net)
+                    ids.append(self.interner.intern_bdp((fwd, rev)))
+                    ids.append(self.interner.intern_ld2(ld2_inv))
+                    ids.append(self.interner.intern_ld3(owner.compute_ld3(ld2_res)))
+
+                # The signatures go first and the .ids file last, so a stored
+                # graph never refers to signatures that are not on disk
+                self._append(start)
+            except BaseException:
+                self._rollback(start)
+                raise
+            with open(self._file(key + '.meta'), 'wb') as handle:
+                marshal.dump((list(csr.labels), trie, len(self.interner)), handle)
+            tmp = ids_path + '.tmp'
+            with open(tmp, 'wb') as handle:
+                ids.tofile(handle)
+            os.replace(tmp, ids_path)
+        return key
+
+    def load(self, graph):
+        """Return the StoredGraph of graph, or None if it is not stored."""
+        key = fingerprint(graph)
+        ids_path = self._file(key + '.ids')
+        if not os.path.exists(ids_path):
+            return None
+        with open(self._file(key + '.meta'), 'rb') as handle:
+            labels, trie, size = marshal.load(handle)
+        if size > len(self.interner):
+            # Added by another writer since the last sync
+            self.sync()
+
+        if key not in self._maps:
+            if os.path.getsize(ids_path):
+                with open(ids_path, 'rb') as handle:
+                    self._maps[key] = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._maps[key] = b''
+        return StoredGraph(key, labels, trie, size, memoryview(self._maps[key]).cast('q'))